@@ -6,12 +6,14 @@ Provides intelligent assistance with command generation and server management
 import asyncio
 import uuid
 import os
-from ollama import AsyncClient
+import time
+from ollama import AsyncClient, ResponseError
 from typing import Dict, Optional, List
 from datetime import datetime
 import logging
-import json
+import orjson
 import re
+import httpx
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,66 @@ OLLAMA_PORT = os.getenv('OLLAMA_PORT', '11434')
 OLLAMA_BASE_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
 AI_MODEL = os.getenv('AI_MODEL', 'gpt-oss:20b')
 
+
+def _optional_int_env(name: str) -> Optional[int]:
+    """Read an optional integer setting, ignoring (with a warning) invalid values"""
+    value = os.getenv(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Ignoring {name}={value!r}: expected an integer")
+        return None
+
+
+# Optional generation limits; unset leaves the model's own defaults in place
+AI_OPTIONS = {
+    name: value
+    for name, value in (
+        ('num_predict', _optional_int_env('AI_NUM_PREDICT')),
+        ('num_ctx', _optional_int_env('AI_NUM_CTX')),
+    )
+    if value is not None
+} or None
+
+# Pool settings for the shared Ollama client: keep connections warm between
+# messages, and leave reads/pool waits unbounded since generations are long
+OLLAMA_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+OLLAMA_TIMEOUT = httpx.Timeout(connect=5.0, read=None, write=10.0, pool=None)
+
+# Upper bound on a single streamed AI reply, in seconds
+AI_RESPONSE_TIMEOUT = 300
+
+# Fenced code blocks in AI replies that may hold bash commands
+CODE_BLOCK_RE = re.compile(r"```(?:bash|sh|shell)?\n(.*?)```", re.DOTALL)
+
+# Dangerous commands
+DANGEROUS_COMMAND_RE = re.compile('|'.join(f'(?:{p})' for p in (
+    r'\brm\s+-rf\s+/',
+    r'\bdd\s+',
+    r'>\s*/dev/sd',
+    r'\bmkfs\b',
+    r'\bformat\b',
+    r'\bshred\b',
+    r':(){:|:&};:',  # fork bomb
+    r'\bchmod\s+-R\s+777',
+    r'\bsudo\s+rm',
+)))
+
+# Caution commands (require sudo or modify system)
+CAUTION_COMMAND_RE = re.compile('|'.join(f'(?:{p})' for p in (
+    r'\bsudo\b',
+    r'\bapt\s+install',
+    r'\byum\s+install',
+    r'\bsystemctl\b',
+    r'\bservice\b',
+    r'\buseradd\b',
+    r'\busermod\b',
+    r'\bpasswd\b',
+    r'\biptables\b',
+)))
+
 logger.info(f"Ollama configured: {OLLAMA_BASE_URL}, Model: {AI_MODEL}")
 
 
@@ -32,12 +94,17 @@ class AIConnectionError(Exception):
 class AISession:
     """Manages a single AI chat session with Ollama"""
 
-    def __init__(self, session_id: str, terminal_session_id: Optional[str] = None, terminal_manager=None):
+    def __init__(self, session_id: str, terminal_session_id: Optional[str] = None, terminal_manager=None,
+                 ollama_client: Optional[AsyncClient] = None):
         self.session_id = session_id
         self.terminal_session_id = terminal_session_id
         self.terminal_manager = terminal_manager
+        self.ollama_client = ollama_client or AsyncClient(
+            OLLAMA_BASE_URL, timeout=OLLAMA_TIMEOUT, limits=OLLAMA_LIMITS
+        )
         self.websocket = None
-        self.created_at = datetime.utcnow()
+        # Monotonic creation time, used only for inactivity cleanup
+        self.created_at = time.monotonic()
         self.message_history: List[Dict] = []
         self.is_connected = True
 
@@ -126,19 +193,18 @@ Stay concise. Commands first, minimal explanation.
 
     async def _stream_ollama_response(self, messages: list) -> None:
         """Stream response from Ollama with timeout handling (Python 3.8 compatible)"""
-        client = AsyncClient(OLLAMA_BASE_URL)
-
         # Note: client.chat() with stream=True needs to be awaited to get the async generator
-        stream = await client.chat(model=self.model, messages=messages, stream=True)
+        stream = await self.ollama_client.chat(
+            model=self.model, messages=messages, stream=True, options=AI_OPTIONS
+        )
 
         full_response = ""
-        start_time = asyncio.get_event_loop().time()
-        timeout_seconds = 300  # 5 minutes
+        deadline = time.monotonic() + AI_RESPONSE_TIMEOUT
 
         try:
             async for chunk in stream:
                 # Manual timeout check (Python 3.8 compatible)
-                if asyncio.get_event_loop().time() - start_time > timeout_seconds:
+                if time.monotonic() > deadline:
                     raise asyncio.TimeoutError()
 
                 if not self.is_connected:
@@ -162,7 +228,7 @@ Stay concise. Commands first, minimal explanation.
             logger.info(f"AI session {self.session_id} completed response ({len(full_response)} chars)")
 
         except asyncio.TimeoutError:
-            logger.error(f"AI session {self.session_id}: Timeout after {timeout_seconds}s")
+            logger.error(f"AI session {self.session_id}: Timeout after {AI_RESPONSE_TIMEOUT}s")
             raise
         except ConnectionError as e:
             logger.error(f"AI session {self.session_id}: Connection failed - {e}")
@@ -171,11 +237,15 @@ Stay concise. Commands first, minimal explanation.
             logger.error(f"AI session {self.session_id}: Streaming error - {e}")
             raise
 
+    async def _send_json(self, payload: dict) -> None:
+        """Serialize a frame with orjson and send it as text"""
+        await self.websocket.send_text(orjson.dumps(payload).decode())
+
     async def _send_chunk(self, content: str) -> None:
         """Send a message chunk to WebSocket"""
         if self.websocket:
             try:
-                await self.websocket.send_json({
+                await self._send_json({
                     'type': 'message_chunk',
                     'content': content,
                     'done': False
@@ -187,7 +257,7 @@ Stay concise. Commands first, minimal explanation.
     async def _send_complete(self, full_message: str) -> None:
         """Send completion message to WebSocket"""
         if self.websocket:
-            await self.websocket.send_json({
+            await self._send_json({
                 'type': 'message_complete',
                 'full_message': full_message
             })
@@ -197,7 +267,7 @@ Stay concise. Commands first, minimal explanation.
         commands = self._extract_commands(response)
         if commands and self.websocket:
             for cmd in commands:
-                await self.websocket.send_json({
+                await self._send_json({
                     'type': 'command_detected',
                     'command': cmd,
                     'safety_level': self._assess_command_safety(cmd)
@@ -207,7 +277,7 @@ Stay concise. Commands first, minimal explanation.
         """Send error message to WebSocket"""
         if self.websocket:
             try:
-                await self.websocket.send_json({
+                await self._send_json({
                     'type': 'error',
                     'message': message
                 })
@@ -217,7 +287,7 @@ Stay concise. Commands first, minimal explanation.
     def _format_error_message(self, error: Exception) -> str:
         """Format error messages for user display"""
         if isinstance(error, asyncio.TimeoutError):
-            return "AI response timed out after 5 minutes. Please try a simpler query."
+            return f"AI response timed out after {AI_RESPONSE_TIMEOUT // 60} minutes. Please try a simpler query."
         elif isinstance(error, ConnectionError):
             return "Cannot connect to Ollama. Please ensure Ollama is running."
         else:
@@ -260,8 +330,7 @@ Stay concise. Commands first, minimal explanation.
     def _extract_commands(self, text: str) -> List[str]:
         """Extract bash commands from AI response"""
         # Look for code blocks with bash/sh/shell
-        pattern = r"```(?:bash|sh|shell)?\n(.*?)```"
-        matches = re.findall(pattern, text, re.DOTALL)
+        matches = CODE_BLOCK_RE.findall(text)
 
         commands = []
         for match in matches:
@@ -282,38 +351,12 @@ Stay concise. Commands first, minimal explanation.
         command_lower = command.lower()
 
         # Dangerous commands
-        dangerous_patterns = [
-            r'\brm\s+-rf\s+/',
-            r'\bdd\s+',
-            r'>\s*/dev/sd',
-            r'\bmkfs\b',
-            r'\bformat\b',
-            r'\bshred\b',
-            r':(){:|:&};:',  # fork bomb
-            r'\bchmod\s+-R\s+777',
-            r'\bsudo\s+rm',
-        ]
-
-        for pattern in dangerous_patterns:
-            if re.search(pattern, command_lower):
-                return 'dangerous'
+        if DANGEROUS_COMMAND_RE.search(command_lower):
+            return 'dangerous'
 
         # Caution commands (require sudo or modify system)
-        caution_patterns = [
-            r'\bsudo\b',
-            r'\bapt\s+install',
-            r'\byum\s+install',
-            r'\bsystemctl\b',
-            r'\bservice\b',
-            r'\buseradd\b',
-            r'\busermod\b',
-            r'\bpasswd\b',
-            r'\biptables\b',
-        ]
-
-        for pattern in caution_patterns:
-            if re.search(pattern, command_lower):
-                return 'caution'
+        if CAUTION_COMMAND_RE.search(command_lower):
+            return 'caution'
 
         # Everything else is considered safe
         return 'safe'
@@ -335,16 +378,20 @@ class AIManager:
     def __init__(self, terminal_manager=None):
         self.sessions: Dict[str, AISession] = {}
         self.terminal_manager = terminal_manager
+        # Shared client so health checks and chat streams reuse pooled connections
+        self.ollama_client = AsyncClient(OLLAMA_BASE_URL, timeout=OLLAMA_TIMEOUT, limits=OLLAMA_LIMITS)
         self._ollama_checked = False
         logger.info("AIManager initialized - Ollama connection will be checked on first use")
 
     async def _check_ollama_connection(self):
-        """Check if Ollama is accessible"""
+        """Check if Ollama is accessible and the configured model is pulled"""
         try:
-            # Try to list models to verify connection
-            client = AsyncClient(OLLAMA_BASE_URL)
-            models = await client.list()
-            logger.info(f"Ollama connection successful. Available models: {len(models.get('models', []))}")
+            # /api/show answers for one model instead of listing every installed one
+            await self.ollama_client.show(AI_MODEL)
+            logger.info(f"Ollama connection successful. Model available: {AI_MODEL}")
+        except ResponseError as e:
+            logger.warning(f"Ollama is reachable but model {AI_MODEL} is not available: {e}")
+            logger.warning(f"Pull it first with 'ollama pull {AI_MODEL}'.")
         except Exception as e:
             logger.warning(f"Could not connect to Ollama: {e}")
             logger.warning("AI features may not work properly. Please ensure Ollama is running.")
@@ -361,7 +408,8 @@ class AIManager:
         session = AISession(
             session_id=session_id,
             terminal_session_id=terminal_session_id,
-            terminal_manager=self.terminal_manager
+            terminal_manager=self.terminal_manager,
+            ollama_client=self.ollama_client
         )
 
         self.sessions[session_id] = session
@@ -383,13 +431,13 @@ class AIManager:
 
     def cleanup_inactive_sessions(self, timeout_minutes: int = 60):
         """Clean up inactive AI sessions"""
-        current_time = datetime.utcnow()
+        current_time = time.monotonic()
         sessions_to_remove = []
 
         for session_id, session in self.sessions.items():
             if not session.is_connected:
                 sessions_to_remove.append(session_id)
-            elif (current_time - session.created_at).total_seconds() > timeout_minutes * 60:
+            elif current_time - session.created_at > timeout_minutes * 60:
                 sessions_to_remove.append(session_id)
 
         for session_id in sessions_to_remove:
@@ -398,6 +446,11 @@ class AIManager:
         if sessions_to_remove:
             logger.info(f"Cleaned up {len(sessions_to_remove)} inactive AI sessions")
 
+    async def aclose(self):
+        """Close the shared Ollama client and its pooled connections"""
+        # ollama's AsyncClient has no public close; shut down the httpx client it wraps
+        await self.ollama_client._client.aclose()
+
 
 # Global AI manager instance (terminal_manager will be set from app.py)
 ai_manager = AIManager()
@@ -8,6 +8,9 @@ from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import asyncio
 import logging
+import os
+import orjson
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 # Import the terminal manager and AI manager we created
@@ -24,8 +27,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Seconds to wait for a client message before sending a keepalive
+WS_RECEIVE_TIMEOUT = 60.0
+
+# Static frames, serialized once instead of per message
+PONG = orjson.dumps({'type': 'pong'}).decode()
+KEEPALIVE = orjson.dumps({'type': 'keepalive'}).decode()
+ERR_INVALID_JSON = orjson.dumps({'type': 'error', 'message': 'Invalid JSON message'}).decode()
+ERR_NO_SESSION = orjson.dumps({'type': 'error', 'message': 'No active session'}).decode()
+ERR_SESSION_RETRIEVE = orjson.dumps({'type': 'error', 'message': 'Failed to retrieve session'}).decode()
+ERR_SESSION_NOT_FOUND = orjson.dumps({'type': 'error', 'message': 'Session not found or disconnected'}).decode()
+ERR_NO_AI_SESSION = orjson.dumps({'type': 'error', 'message': 'No active AI session. Please connect first.'}).decode()
+ERR_AI_SESSION_CREATE = orjson.dumps({'type': 'error', 'message': 'Failed to create AI session'}).decode()
+
+# Envelopes whose only variable part is a server-generated UUID, which never
+# needs JSON escaping: the frame is prefix + session id + suffix
+CONNECTED_PREFIX = '{"type":"connected","session_id":"'
+RECONNECTED_PREFIX = '{"type":"reconnected","session_id":"'
+AI_CONNECTED_PREFIX = '{"type":"connected","ai_session_id":"'
+ID_FRAME_SUFFIX = '"}'
+
+async def send_json(websocket: WebSocket, payload: dict):
+    """Serialize a dynamic frame with orjson and send it as text"""
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+# Release pooled connections held by long-lived clients on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await ai_manager.aclose()
+
 # Create FastAPI app
-app = FastAPI(title="Nexus SSH Terminal", version="0.1.0")
+app = FastAPI(title="Nexus SSH Terminal", version="0.1.0", lifespan=lifespan)
 
 # Add CORS middleware for production
 app.add_middleware(
@@ -41,6 +74,118 @@ app.add_middleware(
 async def health_check():
     return {"status": "healthy", "service": "ssh-terminal"}
 
+# Terminal WebSocket message handlers
+# Each handler takes (websocket, current_session, data) and returns the
+# session that should be current once the message has been processed.
+
+async def _handle_terminal_connect(websocket: WebSocket, current_session, data: dict):
+    """Create a new SSH session and attach the websocket to it"""
+    try:
+        logger.info(f"Creating SSH session to {data['host']}:{data.get('port', 22)}")
+        session_id = await terminal_manager.create_session(
+            host=data['host'],
+            port=data.get('port', 22),
+            username=data['username'],
+            password=data.get('password'),
+            key_path=data.get('key_path')
+        )
+
+        current_session = terminal_manager.get_session(session_id)
+        if current_session:
+            current_session.websocket = websocket
+            logger.info(f"Session {session_id} created and websocket attached")
+
+            await websocket.send_text(CONNECTED_PREFIX + session_id + ID_FRAME_SUFFIX)
+
+            logger.info(f"WebSocket connected to SSH session {session_id}")
+        else:
+            logger.error("Failed to retrieve created session")
+            await websocket.send_text(ERR_SESSION_RETRIEVE)
+
+    except Exception as e:
+        logger.error(f"Failed to create SSH session: {e}", exc_info=True)
+        await send_json(websocket, {
+            'type': 'error',
+            'message': f'Failed to connect: {str(e)}'
+        })
+
+    return current_session
+
+async def _handle_terminal_input(websocket: WebSocket, current_session, data: dict):
+    """Send input to the SSH session"""
+    if current_session and current_session.is_connected:
+        try:
+            input_data = data.get('data', '')
+            logger.debug("Sending input: %r", input_data)
+            await current_session.send_input(input_data)
+        except Exception as e:
+            logger.error(f"Error sending input: {e}")
+            await send_json(websocket, {
+                'type': 'error',
+                'message': f'Error sending input: {str(e)}'
+            })
+    else:
+        logger.warning("No active session for input")
+        await websocket.send_text(ERR_NO_SESSION)
+
+    return current_session
+
+async def _handle_terminal_resize(websocket: WebSocket, current_session, data: dict):
+    """Resize the terminal"""
+    if current_session and current_session.is_connected:
+        try:
+            cols = data.get('cols', 80)
+            rows = data.get('rows', 24)
+            logger.debug("Resizing terminal to %sx%s", cols, rows)
+            current_session.resize(cols, rows)
+        except Exception as e:
+            logger.error(f"Error resizing terminal: {e}")
+
+    return current_session
+
+async def _handle_terminal_reconnect(websocket: WebSocket, current_session, data: dict):
+    """Reattach the websocket to an existing SSH session"""
+    session_id = data.get('session_id')
+    if session_id:
+        current_session = terminal_manager.get_session(session_id)
+        if current_session and current_session.is_connected:
+            current_session.reset_output_credit()
+            current_session.websocket = websocket
+            await websocket.send_text(RECONNECTED_PREFIX + session_id + ID_FRAME_SUFFIX)
+            logger.info(f"Reconnected to session {session_id}")
+        else:
+            await websocket.send_text(ERR_SESSION_NOT_FOUND)
+
+    return current_session
+
+async def _handle_terminal_ack(websocket: WebSocket, current_session, data: dict):
+    """Client acknowledged processing output, returning flow-control credit"""
+    chars = data.get('chars')
+    # Only a positive character count returns credit; anything else is ignored
+    if current_session and isinstance(chars, int) and not isinstance(chars, bool) and chars > 0:
+        current_session.acknowledge_output(chars)
+    return current_session
+
+async def _handle_terminal_ping(websocket: WebSocket, current_session, data: dict):
+    """Respond to ping with pong (a failed send ends the connection)"""
+    await websocket.send_text(PONG)
+    return current_session
+
+async def _handle_terminal_pong(websocket: WebSocket, current_session, data: dict):
+    """Client responded to our keepalive"""
+    logger.debug("Received pong from client")
+    return current_session
+
+TERMINAL_HANDLERS = {
+    'input': _handle_terminal_input,
+    'ack': _handle_terminal_ack,
+    'resize': _handle_terminal_resize,
+    'connect': _handle_terminal_connect,
+    'reconnect': _handle_terminal_reconnect,
+    'ping': _handle_terminal_ping,
+    'pong': _handle_terminal_pong,
+}
+
 # WebSocket endpoint for terminal
 @app.websocket("/ws/terminal")
 async def websocket_terminal(websocket: WebSocket):
@@ -51,6 +196,7 @@ async def websocket_terminal(websocket: WebSocket):
     - Client sends: {"type": "connect", "host": "...", "port": 22, "username": "...", "password": "..."}
     - Client sends: {"type": "input", "data": "..."}
     - Client sends: {"type": "resize", "cols": 80, "rows": 24}
+    - Client sends: {"type": "ack", "chars": N}  # Optional output flow control
     - Server sends: {"type": "output", "data": "..."}
     - Server sends: {"type": "connected", "session_id": "..."}
     - Server sends: {"type": "error", "message": "..."}
@@ -65,164 +211,133 @@ async def websocket_terminal(websocket: WebSocket):
             # Receive message from client
             try:
                 # Add timeout to prevent hanging
-                data = await asyncio.wait_for(websocket.receive_json(), timeout=60.0)
-
-                # Don't log keepalive messages to reduce noise
-                if data.get('type') != 'ping':
-                    logger.debug(f"Received message: {data}")
+                message = await asyncio.wait_for(websocket.receive_text(), timeout=WS_RECEIVE_TIMEOUT)
+                data = orjson.loads(message)
             except asyncio.TimeoutError:
                 logger.debug("WebSocket receive timeout - sending keepalive")
-                # Send keepalive to check if connection is still alive
-                try:
-                    await websocket.send_json({'type': 'keepalive'})
-                except Exception as e:
-                    logger.error(f"Failed to send keepalive: {e}")
-                    break
+                # Send keepalive to check if connection is still alive (a
+                # failed send ends the loop via the outer handler)
+                await websocket.send_text(KEEPALIVE)
                 continue
-            except ValueError as e:
+            except orjson.JSONDecodeError as e:
                 logger.error(f"JSON decode error: {e}")
-                try:
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': 'Invalid JSON message'
-                    })
-                except Exception:
-                    break
+                await websocket.send_text(ERR_INVALID_JSON)
                 continue
-            except Exception as e:
-                logger.error(f"Error receiving WebSocket message: {e}")
-                break
             
             msg_type = data.get('type')
-            logger.debug(f"Processing message type: {msg_type}")
-            
-            if msg_type == 'connect':
-                # Create new SSH session
-                try:
-                    logger.info(f"Creating SSH session to {data['host']}:{data.get('port', 22)}")
-                    session_id = await terminal_manager.create_session(
-                        host=data['host'],
-                        port=data.get('port', 22),
-                        username=data['username'],
-                        password=data.get('password'),
-                        key_path=data.get('key_path')
-                    )
-                    
-                    current_session = terminal_manager.get_session(session_id)
-                    if current_session:
-                        current_session.websocket = websocket
-                        logger.info(f"Session {session_id} created and websocket attached")
-
-                        await websocket.send_json({
-                            'type': 'connected',
-                            'session_id': session_id
-                        })
-
-                        logger.info(f"WebSocket connected to SSH session {session_id}")
-                    else:
-                        logger.error("Failed to retrieve created session")
-                        await websocket.send_json({
-                            'type': 'error',
-                            'message': 'Failed to retrieve session'
-                        })
-                    
-                except Exception as e:
-                    logger.error(f"Failed to create SSH session: {e}", exc_info=True)
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': f'Failed to connect: {str(e)}'
-                    })
-                    
-            elif msg_type == 'input':
-                # Send input to SSH session
-                if current_session and current_session.is_connected:
-                    try:
-                        input_data = data.get('data', '')
-                        logger.debug(f"Sending input: {repr(input_data)}")
-                        await current_session.send_input(input_data)
-                    except Exception as e:
-                        logger.error(f"Error sending input: {e}")
-                        await websocket.send_json({
-                            'type': 'error',
-                            'message': f'Error sending input: {str(e)}'
-                        })
-                else:
-                    logger.warning("No active session for input")
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': 'No active session'
-                    })
-                    
-            elif msg_type == 'resize':
-                # Resize terminal
-                if current_session and current_session.is_connected:
-                    try:
-                        cols = data.get('cols', 80)
-                        rows = data.get('rows', 24)
-                        logger.debug(f"Resizing terminal to {cols}x{rows}")
-                        await current_session.resize(cols, rows)
-                    except Exception as e:
-                        logger.error(f"Error resizing terminal: {e}")
-                        
-            elif msg_type == 'reconnect':
-                # Reconnect to existing session
-                session_id = data.get('session_id')
-                if session_id:
-                    current_session = terminal_manager.get_session(session_id)
-                    if current_session and current_session.is_connected:
-                        current_session.websocket = websocket
-                        await websocket.send_json({
-                            'type': 'reconnected',
-                            'session_id': session_id
-                        })
-                        logger.info(f"Reconnected to session {session_id}")
-                    else:
-                        await websocket.send_json({
-                            'type': 'error',
-                            'message': 'Session not found or disconnected'
-                        })
-                        
-            elif msg_type == 'ping':
-                # Respond to ping with pong
-                try:
-                    await websocket.send_json({'type': 'pong'})
-                except Exception as e:
-                    logger.error(f"Failed to send pong: {e}")
-                    break
-                    
-            elif msg_type == 'pong':
-                # Client responded to our keepalive
-                logger.debug("Received pong from client")
-                        
+
+            # Per-frame debug logging is skipped outright unless enabled;
+            # keepalive messages aren't logged to reduce noise
+            if msg_type != 'ping' and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received message: %s", data)
+
+            handler = TERMINAL_HANDLERS.get(msg_type)
+            if handler:
+                current_session = await handler(websocket, current_session, data)
             else:
                 logger.warning(f"Unknown message type: {msg_type}")
-                try:
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': f'Unknown message type: {msg_type}'
-                    })
-                except Exception as e:
-                    logger.error(f"Failed to send error message: {e}")
-                    break
+                await send_json(websocket, {
+                    'type': 'error',
+                    'message': f'Unknown message type: {msg_type}'
+                })
                         
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected normally")
     except Exception as e:
+        # Don't try to report over a socket that may already be closed
         logger.error(f"WebSocket error: {e}", exc_info=True)
-        try:
-            await websocket.send_json({
-                'type': 'error',
-                'message': str(e)
-            })
-        except Exception:
-            pass
     finally:
         # Clean up
         if current_session:
             current_session.websocket = None
+            current_session.reset_output_credit()
             # Don't close SSH session on WebSocket disconnect - allow reconnection
         logger.info("WebSocket connection closed")
 
+# AI WebSocket message handlers
+# Same contract as the terminal handlers: (websocket, current_ai_session, data)
+# in, the AI session that should be current out.
+
+async def _handle_ai_connect(websocket: WebSocket, current_ai_session, data: dict):
+    """Create a new AI session and attach the websocket to it"""
+    try:
+        terminal_session_id = data.get('terminal_session_id')
+        logger.info(f"Creating AI session (terminal link: {terminal_session_id})")
+
+        session_id = await ai_manager.create_session(
+            terminal_session_id=terminal_session_id
+        )
+
+        current_ai_session = ai_manager.get_session(session_id)
+        if current_ai_session:
+            current_ai_session.websocket = websocket
+            logger.info(f"AI session {session_id} created and websocket attached")
+
+            await websocket.send_text(AI_CONNECTED_PREFIX + session_id + ID_FRAME_SUFFIX)
+
+            logger.info(f"WebSocket connected to AI session {session_id}")
+        else:
+            logger.error("Failed to retrieve created AI session")
+            await websocket.send_text(ERR_AI_SESSION_CREATE)
+
+    except Exception as e:
+        logger.error(f"Failed to create AI session: {e}", exc_info=True)
+        await send_json(websocket, {
+            'type': 'error',
+            'message': f'Failed to create AI session: {str(e)}'
+        })
+
+    return current_ai_session
+
+async def _handle_ai_message(websocket: WebSocket, current_ai_session, data: dict):
+    """Send a message to the AI (the response is streamed by the session)"""
+    if current_ai_session and current_ai_session.is_connected:
+        try:
+            content = data.get('content', '')
+            include_context = data.get('include_context', True)
+
+            logger.info(f"Processing AI message: {content[:100]}...")
+
+            # Send to AI (this will stream the response)
+            await current_ai_session.send_message(content, include_context)
+
+        except Exception as e:
+            logger.error(f"Error processing AI message: {e}", exc_info=True)
+            await send_json(websocket, {
+                'type': 'error',
+                'message': f'AI error: {str(e)}'
+            })
+    else:
+        logger.warning("No active AI session for message")
+        await websocket.send_text(ERR_NO_AI_SESSION)
+
+    return current_ai_session
+
+async def _handle_ai_disconnect(websocket: WebSocket, current_ai_session, data: dict):
+    """Disconnect the AI session"""
+    if current_ai_session:
+        ai_manager.close_session(current_ai_session.session_id)
+        logger.info("AI session disconnected by client")
+    return None
+
+async def _handle_ai_ping(websocket: WebSocket, current_ai_session, data: dict):
+    """Respond to ping with pong (a failed send ends the connection)"""
+    await websocket.send_text(PONG)
+    return current_ai_session
+
+async def _handle_ai_pong(websocket: WebSocket, current_ai_session, data: dict):
+    """Client responded to our keepalive"""
+    logger.debug("Received pong from AI client")
+    return current_ai_session
+
+AI_HANDLERS = {
+    'message': _handle_ai_message,
+    'connect': _handle_ai_connect,
+    'disconnect': _handle_ai_disconnect,
+    'ping': _handle_ai_ping,
+    'pong': _handle_ai_pong,
+}
+
 # WebSocket endpoint for AI chat
 @app.websocket("/ws/ai")
 async def websocket_ai(websocket: WebSocket):
@@ -248,138 +363,40 @@ async def websocket_ai(websocket: WebSocket):
         while True:
             # Receive message from client
             try:
-                data = await asyncio.wait_for(websocket.receive_json(), timeout=60.0)
-
-                # Don't log ping messages to reduce noise
-                if data.get('type') != 'ping':
-                    logger.debug(f"Received AI message: {data}")
-
+                message = await asyncio.wait_for(websocket.receive_text(), timeout=WS_RECEIVE_TIMEOUT)
+                data = orjson.loads(message)
             except asyncio.TimeoutError:
                 logger.debug("AI WebSocket receive timeout - sending keepalive")
-                try:
-                    await websocket.send_json({'type': 'keepalive'})
-                except Exception as e:
-                    logger.error(f"Failed to send keepalive: {e}")
-                    break
+                # Send keepalive to check if connection is still alive (a
+                # failed send ends the loop via the outer handler)
+                await websocket.send_text(KEEPALIVE)
                 continue
-            except ValueError as e:
+            except orjson.JSONDecodeError as e:
                 logger.error(f"JSON decode error: {e}")
-                try:
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': 'Invalid JSON message'
-                    })
-                except Exception:
-                    break
+                await websocket.send_text(ERR_INVALID_JSON)
                 continue
-            except Exception as e:
-                logger.error(f"Error receiving AI WebSocket message: {e}")
-                break
 
             msg_type = data.get('type')
-            logger.debug(f"Processing AI message type: {msg_type}")
-
-            if msg_type == 'connect':
-                # Create new AI session
-                try:
-                    terminal_session_id = data.get('terminal_session_id')
-                    logger.info(f"Creating AI session (terminal link: {terminal_session_id})")
-
-                    session_id = await ai_manager.create_session(
-                        terminal_session_id=terminal_session_id
-                    )
-
-                    current_ai_session = ai_manager.get_session(session_id)
-                    if current_ai_session:
-                        current_ai_session.websocket = websocket
-                        logger.info(f"AI session {session_id} created and websocket attached")
-
-                        await websocket.send_json({
-                            'type': 'connected',
-                            'ai_session_id': session_id
-                        })
-
-                        logger.info(f"WebSocket connected to AI session {session_id}")
-                    else:
-                        logger.error("Failed to retrieve created AI session")
-                        await websocket.send_json({
-                            'type': 'error',
-                            'message': 'Failed to create AI session'
-                        })
-
-                except Exception as e:
-                    logger.error(f"Failed to create AI session: {e}", exc_info=True)
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': f'Failed to create AI session: {str(e)}'
-                    })
-
-            elif msg_type == 'message':
-                # Send message to AI
-                if current_ai_session and current_ai_session.is_connected:
-                    try:
-                        content = data.get('content', '')
-                        include_context = data.get('include_context', True)
-
-                        logger.info(f"Processing AI message: {content[:100]}...")
-
-                        # Send to AI (this will stream the response)
-                        await current_ai_session.send_message(content, include_context)
-
-                    except Exception as e:
-                        logger.error(f"Error processing AI message: {e}", exc_info=True)
-                        await websocket.send_json({
-                            'type': 'error',
-                            'message': f'AI error: {str(e)}'
-                        })
-                else:
-                    logger.warning("No active AI session for message")
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': 'No active AI session. Please connect first.'
-                    })
-
-            elif msg_type == 'disconnect':
-                # Disconnect AI session
-                if current_ai_session:
-                    ai_manager.close_session(current_ai_session.session_id)
-                    current_ai_session = None
-                    logger.info("AI session disconnected by client")
-
-            elif msg_type == 'ping':
-                # Respond to ping with pong
-                try:
-                    await websocket.send_json({'type': 'pong'})
-                except Exception as e:
-                    logger.error(f"Failed to send pong: {e}")
-                    break
-
-            elif msg_type == 'pong':
-                # Client responded to our keepalive
-                logger.debug("Received pong from AI client")
 
+            # Don't log ping messages to reduce noise
+            if msg_type != 'ping' and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received AI message: %s", data)
+
+            handler = AI_HANDLERS.get(msg_type)
+            if handler:
+                current_ai_session = await handler(websocket, current_ai_session, data)
             else:
                 logger.warning(f"Unknown AI message type: {msg_type}")
-                try:
-                    await websocket.send_json({
-                        'type': 'error',
-                        'message': f'Unknown message type: {msg_type}'
-                    })
-                except Exception as e:
-                    logger.error(f"Failed to send error message: {e}")
-                    break
+                await send_json(websocket, {
+                    'type': 'error',
+                    'message': f'Unknown message type: {msg_type}'
+                })
 
     except WebSocketDisconnect:
         logger.info("AI WebSocket disconnected normally")
     except Exception as e:
+        # Don't try to report over a socket that may already be closed
         logger.error(f"AI WebSocket error: {e}", exc_info=True)
-        try:
-            await websocket.send_json({
-                'type': 'error',
-                'message': str(e)
-            })
-        except Exception:
-            pass
     finally:
         # Clean up
         if current_ai_session:
@@ -389,10 +406,15 @@ async def websocket_ai(websocket: WebSocket):
 
 if __name__ == "__main__":
     # Run the application
+    # Terminal and AI sessions live in this process's memory (reconnects and
+    # AI context lookups must land on the same process), so a single worker
+    # is used. uvicorn[standard] picks uvloop/httptools automatically.
     uvicorn.run(
         "app:app",  # Use import string instead of app object
-        host="0.0.0.0",
-        port=8000,
-        log_level="info",
-        reload=True  # Enable auto-reload during development
+        host=os.getenv('NEXUS_HOST', '0.0.0.0'),
+        port=int(os.getenv('NEXUS_PORT', '8000')),
+        log_level=os.getenv('NEXUS_LOG_LEVEL', 'info'),
+        ws="websockets",
+        ws_per_message_deflate=True,  # Terminal output compresses well
+        reload=os.getenv('NEXUS_RELOAD', 'true').lower() == 'true'  # Auto-reload during development
     )
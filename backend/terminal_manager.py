@@ -4,15 +4,59 @@ Provides real interactive terminal sessions via WebSockets
 """
 
 import asyncio
+import codecs
 import asyncssh
+import orjson
 import uuid
-from typing import Dict, Optional
-from datetime import datetime
+import time
+from typing import Dict, List, Optional, Set, Tuple
 import logging
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Window used to coalesce bursts of keystrokes/pasted input into one write
+INPUT_COALESCE_DELAY = 0.001
+
+# Pending input (in characters) past which send_input waits for the SSH channel
+INPUT_BUFFER_MAX = 64 * 1024
+
+# Window and size cap used to batch SSH output chunks into one WebSocket frame
+OUTPUT_COALESCE_DELAY = 0.005
+OUTPUT_COALESCE_MAX = 16 * 1024
+
+# Max characters of output sent but not yet acknowledged by a flow-controlled client
+OUTPUT_CREDIT_WINDOW = 256 * 1024
+
+# A client that can't accept an output frame within this many seconds is dropped
+OUTPUT_SEND_TIMEOUT = 10.0
+
+# Keepalives close a silently dead transport so it stops being shared
+SSH_KEEPALIVE_INTERVAL = 15
+SSH_KEEPALIVE_COUNT_MAX = 3
+
+# Time allowed to open a shell on a shared transport before dialling a new one
+SHARED_SHELL_OPEN_TIMEOUT = 10.0
+
+# Commands run once per session to collect server information for AI context
+SERVER_CONTEXT_COMMANDS = {
+    'os': "uname -s 2>/dev/null || echo 'Unknown'",
+    'kernel': "uname -r 2>/dev/null || echo 'Unknown'",
+    'distro': "cat /etc/os-release 2>/dev/null | grep '^PRETTY_NAME=' | cut -d'\"' -f2 || lsb_release -ds 2>/dev/null || echo 'Unknown'",
+    'arch': "uname -m 2>/dev/null || echo 'Unknown'",
+    'hostname': "hostname 2>/dev/null || echo 'Unknown'",
+    'shell': "echo $SHELL 2>/dev/null || echo 'Unknown'",
+    'user': "whoami 2>/dev/null || echo 'Unknown'",
+    'home': "echo $HOME 2>/dev/null || echo 'Unknown'"
+}
+
+# The commands above joined into one exec, with a marker line between outputs
+SERVER_CONTEXT_SEPARATOR = '__NEXUS_CONTEXT__'
+SERVER_CONTEXT_SCRIPT = f"; echo '{SERVER_CONTEXT_SEPARATOR}'; ".join(SERVER_CONTEXT_COMMANDS.values())
+
+# Time allowed for the whole context script (it replaces eight 5s per-command runs)
+SERVER_CONTEXT_TIMEOUT = 15
+
 class SSHConnectionError(Exception):
     """Raised when SSH connection fails"""
     pass
@@ -36,46 +80,57 @@ class SSHTerminalSession:
         self.process: Optional[asyncssh.SSHClientProcess] = None
         self.websocket = None
         self.is_connected = False
-        self.created_at = datetime.utcnow()
+        # Monotonic creation time, used only for inactivity cleanup
+        self.created_at = time.monotonic()
         self._output_task = None
 
+        # Current PTY size, matching the term_size requested in connect()
+        self._term_size = (80, 24)
+
+        # Pending input waiting to be flushed to the SSH process in one write
+        self._input_buffer: List[str] = []
+        self._input_pending = 0
+        self._input_flush_task = None
+
+        # Incremental decoder so multi-byte characters split across reads survive
+        self._output_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        # Credit-based output flow control, enabled once the client sends its first ack
+        self._flow_control = False
+        self._unacked_output = 0
+        self._output_credit = asyncio.Event()
+        self._output_credit.set()
+        # Inverse of _output_credit, so input backpressure can stop waiting
+        # (and let the receive loop read acks) once output is paused
+        self._output_paused = asyncio.Event()
+
+        # Background closes of detached websockets, referenced until they finish
+        self._close_tasks: Set[asyncio.Task] = set()
+
         # Server context information (collected after connection)
         self.server_context: Dict[str, str] = {}
         
-    async def connect(self):
-        """Establish SSH connection and create interactive shell"""
+    @property
+    def connection_key(self) -> Tuple:
+        """Identity of the SSH transport this session may share with others"""
+        # Credentials are part of the key so a session never rides on a
+        # transport that was authenticated with someone else's secret
+        return (self.host, self.port, self.username, self.password, self.key_path)
+
+    async def connect(self, connection: Optional[asyncssh.SSHClientConnection] = None,
+                      server_context: Optional[Dict[str, str]] = None):
+        """Establish SSH connection (or reuse a shared one) and create interactive shell"""
         try:
-            # Connection options
-            # Use known_hosts file for security (defaults to ~/.ssh/known_hosts)
-            known_hosts_path = Path.home() / '.ssh' / 'known_hosts'
-
-            connect_kwargs = {
-                'host': self.host,
-                'port': self.port,
-                'username': self.username,
-                'known_hosts': str(known_hosts_path) if known_hosts_path.exists() else None,
-            }
-            
-            # Add authentication
-            if self.password:
-                connect_kwargs['password'] = self.password
-            elif self.key_path:
-                connect_kwargs['client_keys'] = [self.key_path]
-            
-            # Establish connection
-            try:
-                self.connection = await asyncssh.connect(**connect_kwargs)
-            except asyncssh.PermissionDenied as e:
-                raise SSHAuthenticationError("Authentication failed") from e
-            except asyncssh.Error as e:
-                raise SSHConnectionError(f"Connection failed: {e}") from e
+            if connection is not None:
+                self.connection = connection
+            else:
+                self.connection = await self._open_connection()
             
             # Create interactive shell process with PTY
             self.process = await self.connection.create_process(
                 term_type='xterm-256color',
-                term_size=(80, 24),
-                encoding='utf-8',  # Let AsyncSSH handle encoding automatically
-                errors='replace'   # Replace invalid UTF-8 sequences
+                term_size=self._term_size,
+                encoding=None  # Raw bytes - output is decoded in _decode_output
             )
             
             self.is_connected = True
@@ -84,8 +139,12 @@ class SSHTerminalSession:
             # Start reading from SSH process
             self._output_task = asyncio.create_task(self._read_ssh_output())
 
-            # Collect server context information
-            asyncio.create_task(self._collect_server_context())
+            # Collect server context information, unless another session on
+            # the same transport already did
+            if server_context:
+                self.server_context = dict(server_context)
+            else:
+                asyncio.create_task(self._collect_server_context())
 
             return True
 
@@ -97,34 +156,49 @@ class SSHTerminalSession:
             self.is_connected = False
             raise SSHConnectionError(f"Unexpected error: {e}") from e
 
+    async def _open_connection(self) -> asyncssh.SSHClientConnection:
+        """Open and authenticate a new SSH transport"""
+        # Use known_hosts file for security (defaults to ~/.ssh/known_hosts)
+        known_hosts_path = Path.home() / '.ssh' / 'known_hosts'
+
+        connect_kwargs = {
+            'host': self.host,
+            'port': self.port,
+            'username': self.username,
+            'known_hosts': str(known_hosts_path) if known_hosts_path.exists() else None,
+            'keepalive_interval': SSH_KEEPALIVE_INTERVAL,
+            'keepalive_count_max': SSH_KEEPALIVE_COUNT_MAX,
+        }
+        
+        # Add authentication
+        if self.password:
+            connect_kwargs['password'] = self.password
+        elif self.key_path:
+            connect_kwargs['client_keys'] = [self.key_path]
+        
+        # Establish connection
+        try:
+            return await asyncssh.connect(**connect_kwargs)
+        except asyncssh.PermissionDenied as e:
+            raise SSHAuthenticationError("Authentication failed") from e
+        except asyncssh.Error as e:
+            raise SSHConnectionError(f"Connection failed: {e}") from e
+
     async def _collect_server_context(self):
         """Collect server information for AI context"""
         try:
             # Wait a bit for shell to be ready
             await asyncio.sleep(0.5)
 
-            # Run commands to gather system info
-            commands = {
-                'os': "uname -s 2>/dev/null || echo 'Unknown'",
-                'kernel': "uname -r 2>/dev/null || echo 'Unknown'",
-                'distro': "cat /etc/os-release 2>/dev/null | grep '^PRETTY_NAME=' | cut -d'\"' -f2 || lsb_release -ds 2>/dev/null || echo 'Unknown'",
-                'arch': "uname -m 2>/dev/null || echo 'Unknown'",
-                'hostname': "hostname 2>/dev/null || echo 'Unknown'",
-                'shell': "echo $SHELL 2>/dev/null || echo 'Unknown'",
-                'user': "whoami 2>/dev/null || echo 'Unknown'",
-                'home': "echo $HOME 2>/dev/null || echo 'Unknown'"
-            }
+            # Run all commands in a single exec rather than one channel each;
+            # a failed exec falls through to the error context below
+            result = await self.connection.run(SERVER_CONTEXT_SCRIPT, check=False, timeout=SERVER_CONTEXT_TIMEOUT)
+            outputs = (result.stdout or '').split(SERVER_CONTEXT_SEPARATOR)
 
             context = {}
-
-            for key, cmd in commands.items():
-                try:
-                    result = await self.connection.run(cmd, check=False, timeout=5)
-                    output = result.stdout.strip() if result.stdout else 'Unknown'
-                    context[key] = output
-                except Exception as e:
-                    logger.debug(f"Failed to collect {key}: {e}")
-                    context[key] = 'Unknown'
+            for index, key in enumerate(SERVER_CONTEXT_COMMANDS):
+                output = outputs[index].strip() if index < len(outputs) else ''
+                context[key] = output or 'Unknown'
 
             self.server_context = context
             logger.info(f"Server context collected for {self.session_id}: {context.get('distro', 'Unknown')}, {context.get('arch', 'Unknown')}")
@@ -135,29 +209,83 @@ class SSHTerminalSession:
     
     async def _read_ssh_output(self):
         """Continuously read output from SSH process and send to WebSocket"""
+        # Bind the per-chunk lookups once; the process stream and decoder are
+        # fixed for the lifetime of this reader (the websocket is not)
+        read = self.process.stdout.read
+        decode = self._decode_output
+        wait_for = asyncio.wait_for
+        now = asyncio.get_running_loop().time
+
         try:
             while self.is_connected and self.process:
+                # Stop reading (and so let SSH window backpressure reach the
+                # server) while the client is too far behind on acks
+                if not self._output_credit.is_set():
+                    await self._output_credit.wait()
+                    continue
+
                 try:
-                    # Read data from SSH process stdout
-                    # AsyncSSH handles encoding automatically now
-                    data = await asyncio.wait_for(self.process.stdout.read(4096), timeout=1.0)
+                    # Read raw bytes from SSH process stdout
+                    raw = await wait_for(read(4096), timeout=1.0)
 
-                    if not data:
+                    if not raw:
                         # EOF reached
                         logger.info(f"SSH process EOF reached for session {self.session_id}")
                         break
 
+                    # Batch whatever else arrives within a short window into the
+                    # same frame, so bursty output isn't sent as many tiny frames
+                    buf = bytearray(raw)
+                    eof = False
+                    read_error = None
+                    deadline = now() + OUTPUT_COALESCE_DELAY
+                    while len(buf) < OUTPUT_COALESCE_MAX:
+                        remaining = deadline - now()
+                        if remaining <= 0:
+                            break
+                        try:
+                            more = await wait_for(read(OUTPUT_COALESCE_MAX - len(buf)), timeout=remaining)
+                        except asyncio.TimeoutError:
+                            break
+                        except Exception as e:
+                            # Send what was already batched before handling the error
+                            read_error = e
+                            break
+                        if not more:
+                            eof = True
+                            break
+                        buf += more
+
+                    data = decode(bytes(buf))
+
                     # Send to WebSocket if we have data
-                    if self.websocket and data:
+                    websocket = self.websocket
+                    if websocket and data:
                         try:
-                            await self.websocket.send_json({
+                            await wait_for(websocket.send_text(orjson.dumps({
                                 'type': 'output',
                                 'data': data
-                            })
-                            logger.debug(f"Sent {len(data)} chars to WebSocket for session {self.session_id}")
+                            }).decode()), timeout=OUTPUT_SEND_TIMEOUT)
+                            logger.debug("Sent %d chars to WebSocket for session %s", len(data), self.session_id)
+                            if self._flow_control:
+                                self._unacked_output += len(data)
+                                if self._unacked_output >= OUTPUT_CREDIT_WINDOW:
+                                    self._output_credit.clear()
+                                    self._output_paused.set()
+                        except asyncio.TimeoutError:
+                            logger.warning(f"WebSocket for session {self.session_id} stalled, dropping client")
+                            self._detach_websocket(websocket, code=1008)
                         except Exception as e:
                             logger.error(f"Error sending to WebSocket: {e}")
-                            return
+                            # Keep reading so a reconnecting client picks up from here
+                            self._detach_websocket(websocket)
+
+                    if read_error is not None:
+                        raise read_error
+
+                    if eof:
+                        logger.info(f"SSH process EOF reached for session {self.session_id}")
+                        break
 
                 except asyncio.TimeoutError:
                     # No data available - timeout is normal
@@ -172,10 +300,10 @@ class SSHTerminalSession:
                     try:
                         stderr_data = await asyncio.wait_for(self.process.stderr.read(1024), timeout=0.1)
                         if stderr_data and self.websocket:
-                            await self.websocket.send_json({
+                            await self.websocket.send_text(orjson.dumps({
                                 'type': 'output',
-                                'data': stderr_data
-                            })
+                                'data': stderr_data.decode('utf-8', errors='replace')
+                            }).decode())
                     except Exception:
                         pass
                     break
@@ -185,29 +313,106 @@ class SSHTerminalSession:
         finally:
             logger.info(f"Output reader for session {self.session_id} stopped")
     
+    def _detach_websocket(self, websocket, code: int = 1011):
+        """Stop sending to a failed/stalled websocket and close it in the background"""
+        if self.websocket is websocket:
+            self.websocket = None
+            self.reset_output_credit()
+
+        async def _close():
+            try:
+                await asyncio.wait_for(websocket.close(code=code), timeout=1.0)
+            except Exception:
+                pass
+
+        task = asyncio.create_task(_close())
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    def acknowledge_output(self, chars: int):
+        """Record output the client has processed, resuming reads once half the window is free"""
+        self._flow_control = True
+        self._unacked_output = max(0, self._unacked_output - chars)
+        if self._unacked_output < OUTPUT_CREDIT_WINDOW // 2:
+            self._output_paused.clear()
+            self._output_credit.set()
+
+    def reset_output_credit(self):
+        """Forget unacknowledged output, e.g. when the websocket is detached or replaced"""
+        self._flow_control = False
+        self._unacked_output = 0
+        self._output_paused.clear()
+        self._output_credit.set()
+
+    def _decode_output(self, raw: bytes) -> str:
+        """Decode SSH output, skipping UTF-8 validation for pure-ASCII chunks"""
+        # ASCII bytes map to the same code points in latin-1 and UTF-8, so
+        # latin-1 is a safe (and much cheaper) decode when nothing is pending
+        if raw.isascii() and not self._output_decoder.getstate()[0]:
+            return raw.decode('latin-1')
+        return self._output_decoder.decode(raw)
+
     async def send_input(self, data: str):
-        """Send input to SSH process"""
+        """Queue input for the SSH process, coalescing bursts into a single write"""
+        if not isinstance(data, str):
+            logger.error(f"Ignoring non-text input for SSH session {self.session_id}: {type(data).__name__}")
+            return
         if self.process and self.is_connected:
-            try:
-                # Write string directly - AsyncSSH handles encoding
-                self.process.stdin.write(data)
-                await self.process.stdin.drain()
-                logger.debug(f"Sent {len(data)} chars to SSH session {self.session_id}")
-            except Exception as e:
-                logger.error(f"Error sending input to SSH session {self.session_id}: {e}")
-                # Don't disconnect on input error, let user retry
-    
-    async def resize(self, cols: int, rows: int):
-        """Resize terminal window"""
+            self._input_buffer.append(data)
+            self._input_pending += len(data)
+            task = self._input_flush_task
+            if task is None:
+                task = self._input_flush_task = asyncio.create_task(self._flush_input())
+            # Push back on the caller (the WebSocket reader) while a stalled
+            # channel has too much input queued, as a direct drain() would -
+            # but not while output waits for acks that only that reader can
+            # deliver, or an echoing remote would deadlock the session
+            if self._input_pending > INPUT_BUFFER_MAX and not self._output_paused.is_set():
+                paused = asyncio.create_task(self._output_paused.wait())
+                try:
+                    await asyncio.wait({task, paused}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    paused.cancel()
+
+    async def _flush_input(self):
+        """Write pending input to the SSH process until none is left, one drain at a time"""
+        try:
+            # Let a paste arriving as many small WebSocket messages accumulate
+            await asyncio.sleep(INPUT_COALESCE_DELAY)
+
+            # Input queued while a drain is blocked goes out in the next write
+            while self._input_buffer and self.process and self.is_connected:
+                chunks = self._input_buffer[:]
+                self._input_buffer.clear()
+                self._input_pending = 0
+                try:
+                    data = ''.join(chunks)
+                    self.process.stdin.write(data.encode('utf-8'))
+                    await self.process.stdin.drain()
+                    logger.debug("Sent %d chars to SSH session %s", len(data), self.session_id)
+                except Exception as e:
+                    logger.error(f"Error sending input to SSH session {self.session_id}: {e}")
+                    # Don't disconnect on input error, let user retry
+        finally:
+            # Only cleared once the buffer is empty (or the session is gone),
+            # so at most one write/drain is ever in flight
+            self._input_flush_task = None
+
+    def resize(self, cols: int, rows: int):
+        """Resize terminal window (a single window-change request, no await needed)"""
+        # Window drags fire many events with the same size; skip the repeats
+        if (cols, rows) == self._term_size:
+            return
         if self.process and self.is_connected:
             try:
                 self.process.change_terminal_size(cols, rows)
-                logger.debug(f"Resized terminal for session {self.session_id} to {cols}x{rows}")
+                self._term_size = (cols, rows)
+                logger.debug("Resized terminal for session %s to %sx%s", self.session_id, cols, rows)
             except Exception as e:
                 logger.error(f"Error resizing terminal for session {self.session_id}: {e}")
     
-    async def disconnect(self):
-        """Close SSH connection and cleanup"""
+    async def disconnect(self, close_connection: bool = True):
+        """Close the shell (and, unless it is shared, the SSH connection) and cleanup"""
         self.is_connected = False
         
         # Cancel output reading task
@@ -217,6 +422,12 @@ class SSHTerminalSession:
                 await self._output_task
             except asyncio.CancelledError:
                 pass
+
+        # Drop any input still waiting to be flushed
+        if self._input_flush_task and not self._input_flush_task.done():
+            self._input_flush_task.cancel()
+        self._input_buffer.clear()
+        self._input_pending = 0
         
         if self.process:
             try:
@@ -230,13 +441,13 @@ class SSHTerminalSession:
                 logger.error(f"Error closing process for session {self.session_id}: {e}")
             self.process = None
             
-        if self.connection:
+        if self.connection and close_connection:
             try:
                 self.connection.close()
                 await self.connection.wait_closed()
             except Exception as e:
                 logger.error(f"Error closing connection for session {self.session_id}: {e}")
-            self.connection = None
+        self.connection = None
             
         logger.info(f"SSH session {self.session_id} disconnected")
 
@@ -246,6 +457,10 @@ class TerminalManager:
     
     def __init__(self):
         self.sessions: Dict[str, SSHTerminalSession] = {}
+        # Open SSH transports keyed by SSHTerminalSession.connection_key, and
+        # how many sessions currently run a shell on each of them
+        self._shared_connections: Dict[Tuple, asyncssh.SSHClientConnection] = {}
+        self._connection_refs: Dict[asyncssh.SSHClientConnection, int] = {}
         
     async def create_session(self, host: str, port: int, username: str, 
                             password: Optional[str] = None, key_path: Optional[str] = None) -> str:
@@ -261,11 +476,44 @@ class TerminalManager:
             key_path=key_path
         )
         
-        await session.connect()
+        key = session.connection_key
+        shared = self._shared_connections.get(key)
+        if shared is not None:
+            try:
+                # Open another shell channel on the existing transport; a
+                # transport that died silently never answers, so don't wait long
+                await asyncio.wait_for(
+                    session.connect(connection=shared, server_context=self._known_server_context(shared)),
+                    timeout=SHARED_SHELL_OPEN_TIMEOUT
+                )
+            except (SSHConnectionError, asyncio.TimeoutError) as e:
+                # Transport died or hit the server's session limit - stop
+                # handing it out and dial a fresh one for this session
+                logger.info(f"Shared SSH connection to {host} unusable ({str(e) or 'timed out'}), opening a new one")
+                self._shared_connections.pop(key, None)
+                shared = None
+
+        if shared is None:
+            await session.connect()
+            self._shared_connections[key] = session.connection
+
+        self._connection_refs[session.connection] = self._connection_refs.get(session.connection, 0) + 1
         self.sessions[session_id] = session
         
         return session_id
     
+    def _known_server_context(self, connection: asyncssh.SSHClientConnection) -> Optional[Dict[str, str]]:
+        """Server context already collected by a session on the given transport"""
+        for session in self.sessions.values():
+            context = session.server_context
+            if session.connection is not connection or not context or 'error' in context:
+                continue
+            # A probe that learned nothing is not worth sharing; let the new session retry
+            if all(value == 'Unknown' for value in context.values()):
+                continue
+            return context
+        return None
+
     def get_session(self, session_id: str) -> Optional[SSHTerminalSession]:
         """Get an existing session"""
         return self.sessions.get(session_id)
@@ -274,19 +522,40 @@ class TerminalManager:
         """Close and remove a session"""
         if session_id in self.sessions:
             session = self.sessions[session_id]
-            await session.disconnect()
+            key = session.connection_key
+            connection = session.connection
+            await session.disconnect(close_connection=False)
             del self.sessions[session_id]
+            if connection:
+                await self._release_connection(key, connection)
             logger.info(f"Removed session {session_id}")
+
+    async def _release_connection(self, key: Tuple, connection: asyncssh.SSHClientConnection):
+        """Drop a session's reference to a transport, closing it after the last one"""
+        remaining = self._connection_refs.get(connection, 1) - 1
+        if remaining > 0:
+            self._connection_refs[connection] = remaining
+            return
+
+        self._connection_refs.pop(connection, None)
+        if self._shared_connections.get(key) is connection:
+            del self._shared_connections[key]
+
+        try:
+            connection.close()
+            await connection.wait_closed()
+        except Exception as e:
+            logger.error(f"Error closing SSH connection to {key[0]}: {e}")
     
     async def cleanup_inactive_sessions(self, timeout_minutes: int = 30):
         """Clean up inactive sessions"""
-        current_time = datetime.utcnow()
+        current_time = time.monotonic()
         sessions_to_remove = []
         
         for session_id, session in self.sessions.items():
             if not session.is_connected:
                 sessions_to_remove.append(session_id)
-            elif (current_time - session.created_at).total_seconds() > timeout_minutes * 60:
+            elif current_time - session.created_at > timeout_minutes * 60:
                 sessions_to_remove.append(session_id)
         
         for session_id in sessions_to_remove: